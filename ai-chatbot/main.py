@@ -1,8 +1,14 @@
+import time
+
+# Mốc thời gian khởi động process, lấy trước các import nặng (google.generativeai, glm)
+# để startup time tính cả thời gian import
+PROCESS_STARTED_AT = time.perf_counter()
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import Header, HTTPException
+from fastapi import Header, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Callable, Awaitable
 from enum import Enum
 import google.generativeai as genai
 import google.ai.generativelanguage as glm
@@ -12,211 +18,343 @@ import json
 import requests
 from dotenv import load_dotenv
 import re
+import asyncio
+import hashlib
+import threading
+from contextlib import asynccontextmanager
+from requests.adapters import HTTPAdapter
+from brotli_asgi import BrotliMiddleware
+from collections import Counter
+import hmac
+import random
+import sys
+import itertools
+import uuid
 # Load environment variables
 load_dotenv()
 
-# Định nghĩa tools cho chatbot
-tools = [
-    glm.Tool(
-        function_declarations=[
-            glm.FunctionDeclaration(
-                name="create_message",
-                description="Tạo tin nhắn mới trong cuộc trò chuyện. Nếu chưa có chat_id, hệ thống sẽ tự động tạo một cuộc trò chuyện mới.",
-                parameters=glm.Schema(
-                    type=glm.Type.OBJECT,
-                    properties={
-                        "content": glm.Schema(
-                            type=glm.Type.STRING,
-                            description="Nội dung tin nhắn cần gửi"
-                        ),
-                        "sender": glm.Schema(
-                            type=glm.Type.STRING,
-                            description="Người gửi tin nhắn (USER hoặc BOT)"
-                        ),
-                        "chatId": glm.Schema(
-                            type=glm.Type.INTEGER,
-                            description="ID của cuộc trò chuyện. Nếu không có, hệ thống sẽ tạo mới"
-                        )
-                    },
-                    required=["content", "sender"]
+# Định nghĩa tools cho chatbot (được build một lần trong lifespan)
+def build_tools() -> List[glm.Tool]:
+    return [
+        glm.Tool(
+            function_declarations=[
+                glm.FunctionDeclaration(
+                    name="create_message",
+                    description="Tạo tin nhắn mới trong cuộc trò chuyện. Nếu chưa có chat_id, hệ thống sẽ tự động tạo một cuộc trò chuyện mới.",
+                    parameters=glm.Schema(
+                        type=glm.Type.OBJECT,
+                        properties={
+                            "content": glm.Schema(
+                                type=glm.Type.STRING,
+                                description="Nội dung tin nhắn cần gửi"
+                            ),
+                            "sender": glm.Schema(
+                                type=glm.Type.STRING,
+                                description="Người gửi tin nhắn (USER hoặc BOT)"
+                            ),
+                            "chatId": glm.Schema(
+                                type=glm.Type.INTEGER,
+                                description="ID của cuộc trò chuyện. Nếu không có, hệ thống sẽ tạo mới"
+                            )
+                        },
+                        required=["content", "sender"]
+                    )
                 )
-            )
-        ]
-    ),
-    glm.Tool(
-        function_declarations=[
-            glm.FunctionDeclaration(
-                name="find_messages",
-                description="Tìm kiếm và lấy danh sách tin nhắn trong một cuộc trò chuyện cụ thể, có phân trang.",
-                parameters=glm.Schema(
-                    type=glm.Type.OBJECT,
-                    properties={
-                        "chatId": glm.Schema(
-                            type=glm.Type.INTEGER,
-                            description="ID của cuộc trò chuyện cần tìm kiếm tin nhắn"
-                        ),
-                        "page": glm.Schema(
-                            type=glm.Type.INTEGER,
-                            description="Số trang cần lấy (mặc định là 1)"
-                        ),
-                        "limit": glm.Schema(
-                            type=glm.Type.INTEGER,
-                            description="Số lượng tin nhắn tối đa trên mỗi trang (mặc định là 10)"
-                        ),
-                        "fetchAll": glm.Schema(
-                            type=glm.Type.BOOLEAN,
-                            description="Nếu true, sẽ lấy tất cả tin nhắn mà không phân trang"
-                        )
-                    },
-                    required=["chatId"]
+            ]
+        ),
+        glm.Tool(
+            function_declarations=[
+                glm.FunctionDeclaration(
+                    name="find_messages",
+                    description="Tìm kiếm và lấy danh sách tin nhắn trong một cuộc trò chuyện cụ thể, có phân trang.",
+                    parameters=glm.Schema(
+                        type=glm.Type.OBJECT,
+                        properties={
+                            "chatId": glm.Schema(
+                                type=glm.Type.INTEGER,
+                                description="ID của cuộc trò chuyện cần tìm kiếm tin nhắn"
+                            ),
+                            "page": glm.Schema(
+                                type=glm.Type.INTEGER,
+                                description="Số trang cần lấy (mặc định là 1)"
+                            ),
+                            "limit": glm.Schema(
+                                type=glm.Type.INTEGER,
+                                description="Số lượng tin nhắn tối đa trên mỗi trang (mặc định là 10)"
+                            ),
+                            "fetchAll": glm.Schema(
+                                type=glm.Type.BOOLEAN,
+                                description="Nếu true, sẽ lấy tất cả tin nhắn mà không phân trang"
+                            ),
+                            "sinceId": glm.Schema(
+                                type=glm.Type.INTEGER,
+                                description="Chỉ lấy các tin nhắn có id lớn hơn giá trị này (lấy tin nhắn mới)"
+                            )
+                        },
+                        required=["chatId"]
+                    )
                 )
-            )
-        ]
-    ),
-    glm.Tool(
-        function_declarations=[
-            glm.FunctionDeclaration(
-                name="find_classes",
-                description="Tìm kiếm và lấy danh sách các lớp học với các bộ lọc khác nhau. Tất cả các tham số đều tùy chọn.",
-                parameters=glm.Schema(
-                    type=glm.Type.OBJECT,
-                    properties={
-                        "name": glm.Schema(
-                            type=glm.Type.STRING,
-                            description="Tên lớp học cần tìm kiếm (tìm kiếm mờ)"
-                        ),
-                        "status": glm.Schema(
-                            type=glm.Type.STRING,
-                            description="Trạng thái của lớp học (ACTIVE, INACTIVE, etc.)"
-                        ),
-                        "page": glm.Schema(
-                            type=glm.Type.INTEGER,
-                            description="Số trang cần lấy (mặc định là 1)"
-                        ),
-                        "rowPerPage": glm.Schema(
-                            type=glm.Type.INTEGER,
-                            description="Số lượng lớp học tối đa trên mỗi trang (mặc định là 10)"
-                        ),
-                        "learningDate": glm.Schema(
-                            type=glm.Type.STRING,
-                            description="Ngày học cụ thể để lọc (format: YYYY-MM-DD)"
-                        ),
-                        "month": glm.Schema(
-                            type=glm.Type.INTEGER,
-                            description="Tháng cần lấy lịch học (1-12)"
-                        ),
-                        "year": glm.Schema(
-                            type=glm.Type.INTEGER,
-                            description="Năm cần lấy lịch học"
-                        )
-                    }
+            ]
+        ),
+        glm.Tool(
+            function_declarations=[
+                glm.FunctionDeclaration(
+                    name="find_classes",
+                    description="Tìm kiếm và lấy danh sách các lớp học với các bộ lọc khác nhau, có phân trang. Tất cả các tham số đều tùy chọn. Nếu kết quả có nextCursor khác null và cần thêm lớp học, gọi lại với cursor=nextCursor.",
+                    parameters=glm.Schema(
+                        type=glm.Type.OBJECT,
+                        properties={
+                            "name": glm.Schema(
+                                type=glm.Type.STRING,
+                                description="Tên lớp học cần tìm kiếm (tìm kiếm mờ)"
+                            ),
+                            "status": glm.Schema(
+                                type=glm.Type.STRING,
+                                description="Trạng thái của lớp học (ACTIVE, INACTIVE, etc.)"
+                            ),
+                            "page": glm.Schema(
+                                type=glm.Type.INTEGER,
+                                description="Số trang cần lấy (mặc định là 1)"
+                            ),
+                            "rowPerPage": glm.Schema(
+                                type=glm.Type.INTEGER,
+                                description="Số lượng lớp học tối đa trên mỗi trang (mặc định là 20)"
+                            ),
+                            "cursor": glm.Schema(
+                                type=glm.Type.INTEGER,
+                                description="Lấy trang tiếp theo: truyền giá trị nextCursor của kết quả trước"
+                            ),
+                            "includeSessions": glm.Schema(
+                                type=glm.Type.BOOLEAN,
+                                description="Có lấy các buổi học của lớp hay không (mặc định true). Đặt false nếu chỉ cần id, tên, trạng thái"
+                            ),
+                            "fetchAll": glm.Schema(
+                                type=glm.Type.BOOLEAN,
+                                description="Nếu true, lấy tất cả lớp học không phân trang. Chỉ dùng khi thật sự cần toàn bộ danh sách"
+                            ),
+                            "learningDate": glm.Schema(
+                                type=glm.Type.STRING,
+                                description="Ngày học cụ thể để lọc (format: YYYY-MM-DD). Khi lọc theo ngày sẽ trả về tất cả lớp học trong ngày, không dùng cursor"
+                            ),
+                            "month": glm.Schema(
+                                type=glm.Type.INTEGER,
+                                description="Tháng cần lấy lịch học (1-12)"
+                            ),
+                            "year": glm.Schema(
+                                type=glm.Type.INTEGER,
+                                description="Năm cần lấy lịch học"
+                            )
+                        }
+                    )
                 )
-            )
-        ]
-    ),
-    glm.Tool(
-        function_declarations=[
-            glm.FunctionDeclaration(
-                name="create_student",
-                description="Tạo học sinh mới và gán vào lớp học. Yêu cầu quyền ADMIN hoặc TA với permission CREATE_STUDENT.",
-                parameters=glm.Schema(
-                    type=glm.Type.OBJECT,
-                    properties={
-                        "name": glm.Schema(
-                            type=glm.Type.STRING,
-                            description="Tên học sinh"
-                        ),
-                        "classId": glm.Schema(
-                            type=glm.Type.INTEGER,
-                            description="ID của lớp học mà học sinh sẽ được gán vào"
-                        ),
-                        "dob": glm.Schema(
-                            type=glm.Type.STRING,
-                            description="Ngày sinh của học sinh (định dạng YYYY-MM-DD)"
-                        ),
-                        "parent": glm.Schema(
-                            type=glm.Type.STRING,
-                            description="Tên phụ huynh của học sinh"
-                        ),
-                        "phoneNumber": glm.Schema(
-                            type=glm.Type.STRING,
-                            description="Số điện thoại chính của học sinh"
-                        ),
-                        "secondPhoneNumber": glm.Schema(
-                            type=glm.Type.STRING,
-                            description="Số điện thoại phụ của học sinh (tùy chọn)"
-                        )
-                    },
-                    required=["name", "classId", "dob", "parent", "phoneNumber"]
+            ]
+        ),
+        glm.Tool(
+            function_declarations=[
+                glm.FunctionDeclaration(
+                    name="create_student",
+                    description="Tạo học sinh mới và gán vào lớp học. Yêu cầu quyền ADMIN hoặc TA với permission CREATE_STUDENT.",
+                    parameters=glm.Schema(
+                        type=glm.Type.OBJECT,
+                        properties={
+                            "name": glm.Schema(
+                                type=glm.Type.STRING,
+                                description="Tên học sinh"
+                            ),
+                            "classId": glm.Schema(
+                                type=glm.Type.INTEGER,
+                                description="ID của lớp học mà học sinh sẽ được gán vào"
+                            ),
+                            "dob": glm.Schema(
+                                type=glm.Type.STRING,
+                                description="Ngày sinh của học sinh (định dạng YYYY-MM-DD)"
+                            ),
+                            "parent": glm.Schema(
+                                type=glm.Type.STRING,
+                                description="Tên phụ huynh của học sinh"
+                            ),
+                            "phoneNumber": glm.Schema(
+                                type=glm.Type.STRING,
+                                description="Số điện thoại chính của học sinh"
+                            ),
+                            "secondPhoneNumber": glm.Schema(
+                                type=glm.Type.STRING,
+                                description="Số điện thoại phụ của học sinh (tùy chọn)"
+                            )
+                        },
+                        required=["name", "classId", "dob", "parent", "phoneNumber"]
+                    )
                 )
-            )
-        ]
-    ),
-    glm.Tool(
-        function_declarations=[
-            glm.FunctionDeclaration(
-                name="create_class",
-                description="Tạo lớp học mới. Yêu cầu quyền ADMIN.",
-                parameters=glm.Schema(
-                    type=glm.Type.OBJECT,
-                    properties={
-                        "name": glm.Schema(
-                            type=glm.Type.STRING,
-                            description="Tên lớp học"
-                        ),
-                        "description": glm.Schema(
-                            type=glm.Type.STRING,
-                            description="Mô tả lớp học"
-                        ),
-                        "status": glm.Schema(
-                            type=glm.Type.STRING,
-                            description="Trạng thái lớp học (ACTIVE hoặc INACTIVE)",
-                            enum=["ACTIVE", "INACTIVE"]
-                        ),
-                        "sessions": glm.Schema(
-                            type=glm.Type.ARRAY,
-                            description="Danh sách các buổi học của lớp",
-                            items=glm.Schema(
-                                type=glm.Type.OBJECT,
-                                properties={
-                                    "sessionKey": glm.Schema(
-                                        type=glm.Type.STRING,
-                                        description="Mã buổi học (SESSION_1 đến SESSION_7, tương ứng với thứ 2 đến chủ nhật)",
-                                        enum=["SESSION_1", "SESSION_2", "SESSION_3", "SESSION_4", "SESSION_5", "SESSION_6", "SESSION_7"]
-                                    ),
-                                    "startTime": glm.Schema(
-                                        type=glm.Type.STRING,
-                                        description="Thời gian bắt đầu (định dạng HH:mm)"
-                                    ),
-                                    "endTime": glm.Schema(
-                                        type=glm.Type.STRING,
-                                        description="Thời gian kết thúc (định dạng HH:mm)"
-                                    ),
-                                    "amount": glm.Schema(
-                                        type=glm.Type.NUMBER,
-                                        description="Học phí cho buổi học"
-                                    )
-                                },
-                                required=["sessionKey", "startTime", "endTime", "amount"]
+            ]
+        ),
+        glm.Tool(
+            function_declarations=[
+                glm.FunctionDeclaration(
+                    name="create_class",
+                    description="Tạo lớp học mới. Yêu cầu quyền ADMIN.",
+                    parameters=glm.Schema(
+                        type=glm.Type.OBJECT,
+                        properties={
+                            "name": glm.Schema(
+                                type=glm.Type.STRING,
+                                description="Tên lớp học"
+                            ),
+                            "description": glm.Schema(
+                                type=glm.Type.STRING,
+                                description="Mô tả lớp học"
+                            ),
+                            "status": glm.Schema(
+                                type=glm.Type.STRING,
+                                description="Trạng thái lớp học (ACTIVE hoặc INACTIVE)",
+                                enum=["ACTIVE", "INACTIVE"]
+                            ),
+                            "sessions": glm.Schema(
+                                type=glm.Type.ARRAY,
+                                description="Danh sách các buổi học của lớp",
+                                items=glm.Schema(
+                                    type=glm.Type.OBJECT,
+                                    properties={
+                                        "sessionKey": glm.Schema(
+                                            type=glm.Type.STRING,
+                                            description="Mã buổi học (SESSION_1 đến SESSION_7, tương ứng với thứ 2 đến chủ nhật)",
+                                            enum=["SESSION_1", "SESSION_2", "SESSION_3", "SESSION_4", "SESSION_5", "SESSION_6", "SESSION_7"]
+                                        ),
+                                        "startTime": glm.Schema(
+                                            type=glm.Type.STRING,
+                                            description="Thời gian bắt đầu (định dạng HH:mm)"
+                                        ),
+                                        "endTime": glm.Schema(
+                                            type=glm.Type.STRING,
+                                            description="Thời gian kết thúc (định dạng HH:mm)"
+                                        ),
+                                        "amount": glm.Schema(
+                                            type=glm.Type.NUMBER,
+                                            description="Học phí cho buổi học"
+                                        )
+                                    },
+                                    required=["sessionKey", "startTime", "endTime", "amount"]
+                                )
                             )
-                        )
-                    },
-                    required=["name", "description", "status", "sessions"]
+                        },
+                        required=["name", "description", "status", "sessions"]
+                    )
                 )
-            )
-        ]
+            ]
+        )
+    ]
+
+MODEL_NAME = "gemini-2.5-flash-preview-04-17"
+SYSTEM_PROMPT_PATH = "prompts/system_prompt.txt"
+
+# Được khởi tạo trong lifespan
+model = None
+system_prompt_content = None
+
+# Session dùng chung để tái sử dụng connection pool tới backend
+BACKEND_POOL_SIZE = int(os.getenv("BACKEND_POOL_SIZE", "20"))
+http_session = requests.Session()
+http_session.mount("http://", HTTPAdapter(pool_maxsize=BACKEND_POOL_SIZE))
+http_session.mount("https://", HTTPAdapter(pool_maxsize=BACKEND_POOL_SIZE))
+
+# Chu kỳ thử warm lại khi backend hoặc model chưa sẵn sàng (giây)
+WARM_UP_RETRY_SECONDS = float(os.getenv("WARM_UP_RETRY_SECONDS", "5"))
+
+# Trạng thái khởi động cho /healthz và /readyz
+app_state = {
+    "ready": False,
+    "startup_seconds": None,
+    "backend_warm": False,
+    "model_warm": False
+}
+
+
+def warm_backend():
+    """Mở sẵn kết nối tới backend để request đầu tiên không phải chờ handshake"""
+    try:
+        http_session.get(BACKEND_URL, timeout=5)
+        app_state["backend_warm"] = True
+    except requests.exceptions.RequestException as e:
+        print(f"Backend warm-up failed: {str(e)}")
+
+
+def warm_model():
+    """Khởi tạo client generate_content (kênh gRPC mà /chat dùng) và kiểm tra model"""
+    try:
+        # count_tokens đi qua cùng client với generate_content nhưng không tốn token sinh
+        model.count_tokens("ping")
+        app_state["model_warm"] = True
+    except Exception as e:
+        print(f"Model warm-up failed: {str(e)}")
+
+
+async def warm_up() -> bool:
+    """Warm các thành phần chưa sẵn sàng; chỉ ready khi cả backend và model đều warm"""
+    pending = []
+    if not app_state["backend_warm"]:
+        pending.append(asyncio.to_thread(warm_backend))
+    if not app_state["model_warm"]:
+        pending.append(asyncio.to_thread(warm_model))
+    await asyncio.gather(*pending)
+
+    if app_state["backend_warm"] and app_state["model_warm"] and not app_state["ready"]:
+        app_state["startup_seconds"] = round(time.perf_counter() - PROCESS_STARTED_AT, 3)
+        app_state["ready"] = True
+        print(f"Chatbot ready in {app_state['startup_seconds']}s")
+    return app_state["ready"]
+
+
+async def retry_warm_up():
+    """Thử warm lại định kỳ cho tới khi sẵn sàng; trong lúc đó /readyz trả về 503"""
+    while not app_state["ready"]:
+        await asyncio.sleep(WARM_UP_RETRY_SECONDS)
+        await warm_up()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global model, system_prompt_content
+
+    # Configure Gemini
+    genai.configure(api_key=os.getenv("API_KEY"))
+    model = genai.GenerativeModel(
+        model_name=MODEL_NAME,
+        tools=build_tools()
     )
-]
 
-# Configure Gemini
-genai.configure(api_key=os.getenv("API_KEY"))
-model = genai.GenerativeModel(
-    model_name="gemini-2.5-flash-preview-04-17",
-    tools=tools
-)
+    # Đọc system prompt một lần, dùng lại cho mọi request
+    with open(SYSTEM_PROMPT_PATH, "r", encoding="utf-8") as f:
+        system_prompt_content = glm.Content(
+            role="model",
+            parts=[glm.Part(text=f.read())]
+        )
+
+    await job_manager.start()
+
+    background_tasks = [asyncio.create_task(monitor_event_loop_lag())]
+    if USAGE_EXPORT_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(export_usage_periodically()))
+
+    if not await warm_up():
+        background_tasks.append(asyncio.create_task(retry_warm_up()))
+
+    yield
+
+    app_state["ready"] = False
+    await job_manager.stop()
+    for task in background_tasks:
+        task.cancel()
+    # Chờ các lần ghi nhận usage còn dở rồi mới export lần cuối
+    if usage_tasks:
+        await asyncio.wait(list(usage_tasks), timeout=TOKEN_USER_LOOKUP_TIMEOUT_SECONDS + 1)
+    try:
+        await asyncio.to_thread(usage_store.export, USAGE_EXPORT_PATH)
+    except Exception as e:
+        print(f"Error exporting usage stats: {str(e)}")
+    http_session.close()
+
 
 # Initialize FastAPI
-app = FastAPI(title="School Management Chatbot")
+app = FastAPI(title="School Management Chatbot", lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -227,9 +365,71 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+# Nén response lớn: br nếu client hỗ trợ, nếu không thì gzip
+app.add_middleware(
+    BrotliMiddleware,
+    minimum_size=int(os.getenv("COMPRESSION_MIN_SIZE", "1024")),
+    gzip_fallback=True
+)
+
 # Base URL for backend
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:3010")
 
+# Ngân sách cho mỗi request (0 = không giới hạn)
+MAX_TOKENS_PER_REQUEST = int(os.getenv("MAX_TOKENS_PER_REQUEST", "0"))
+MAX_FUNCTION_CALLS_PER_REQUEST = int(os.getenv("MAX_FUNCTION_CALLS_PER_REQUEST", "20"))
+
+# Deadline cho toàn bộ request /chat (giây); client có thể ghi đè trong khoảng [MIN, MAX]
+CHAT_DEADLINE_SECONDS = float(os.getenv("CHAT_DEADLINE_SECONDS", "60"))
+MIN_CHAT_DEADLINE_SECONDS = float(os.getenv("MIN_CHAT_DEADLINE_SECONDS", "5"))
+MAX_CHAT_DEADLINE_SECONDS = float(os.getenv("MAX_CHAT_DEADLINE_SECONDS", "120"))
+# Timeout mặc định cho một lần gọi backend khi không có deadline
+BACKEND_TIMEOUT_SECONDS = float(os.getenv("BACKEND_TIMEOUT_SECONDS", "30"))
+
+# Thời gian cache user_id đã xác thực của một token
+TOKEN_USER_CACHE_TTL_SECONDS = float(os.getenv("TOKEN_USER_CACHE_TTL_SECONDS", "300"))
+TOKEN_USER_FAILURE_TTL_SECONDS = float(os.getenv("TOKEN_USER_FAILURE_TTL_SECONDS", "30"))  # Cache cả lần tra cứu lỗi
+TOKEN_USER_LOOKUP_TIMEOUT_SECONDS = float(os.getenv("TOKEN_USER_LOOKUP_TIMEOUT_SECONDS", "3"))
+TOKEN_USER_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_USER_CACHE_MAX_ENTRIES", "10000"))
+
+# Xuất thống kê token định kỳ (giây, 0 = tắt)
+USAGE_EXPORT_INTERVAL = int(os.getenv("USAGE_EXPORT_INTERVAL", "300"))
+USAGE_EXPORT_PATH = os.getenv("USAGE_EXPORT_PATH", "usage_stats.json")
+USAGE_MAX_KEYS = int(os.getenv("USAGE_MAX_KEYS", "10000"))  # Số user/chat tối đa giữ trong bộ nhớ
+
+# Phiên chat qua WebSocket
+WS_MAX_SESSIONS = int(os.getenv("WS_MAX_SESSIONS", "100"))  # Số phiên tối đa trên mỗi worker
+WS_IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "300"))
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "32"))
+WS_AUTH_TIMEOUT_SECONDS = float(os.getenv("WS_AUTH_TIMEOUT_SECONDS", "10"))  # Chờ frame auth đầu tiên
+
+# Job chat chạy nền (run_async=true)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "100"))
+JOB_DEADLINE_SECONDS = float(os.getenv("JOB_DEADLINE_SECONDS", "300"))
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", "3600"))
+JOB_SHUTDOWN_GRACE_SECONDS = float(os.getenv("JOB_SHUTDOWN_GRACE_SECONDS", "20"))
+JOB_CANCEL_WAIT_SECONDS = float(os.getenv("JOB_CANCEL_WAIT_SECONDS", "5"))  # Chờ job dừng ở bước tiếp theo trước khi hủy hẳn
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "pending_jobs.json")  # Job chưa xong khi tắt service (không lưu token)
+
+# Cache cho /chat/warm (lịch sử chat, danh sách lớp học)
+WARM_CACHE_TTL_SECONDS = float(os.getenv("WARM_CACHE_TTL_SECONDS", "60"))
+WARM_CACHE_MAX_ENTRIES = int(os.getenv("WARM_CACHE_MAX_ENTRIES", "1000"))
+
+# Số lớp học mỗi trang khi find_classes không chỉ định rowPerPage
+FIND_CLASSES_PAGE_SIZE = int(os.getenv("FIND_CLASSES_PAGE_SIZE", "20"))
+# Thời gian giữ lịch sử chat để chỉ lấy thêm tin nhắn mới
+HISTORY_CACHE_TTL_SECONDS = float(os.getenv("HISTORY_CACHE_TTL_SECONDS", "900"))
+
+# Số id tối đa trong bản tóm tắt api_responses (response_mode=compact)
+SUMMARY_MAX_IDS = int(os.getenv("SUMMARY_MAX_IDS", "20"))
+
+# Profiling theo yêu cầu (không đặt PROFILE_ADMIN_SECRET = tắt các endpoint /debug)
+PROFILE_ADMIN_SECRET = os.getenv("PROFILE_ADMIN_SECRET")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.1"))
+
 
 # =========================
 # ======= Models ==========
@@ -239,17 +439,419 @@ class Sender(str, Enum):
     USER = "USER"
     BOT = "BOT"
 
+class ResponseMode(str, Enum):
+    COMPACT = "compact"  # Chỉ trả về tóm tắt (số lượng, ids) của api_responses
+    FULL = "full"  # Trả về nguyên api_responses từ backend
+
 class ChatRequest(BaseModel):
     message: str
     user_id: Optional[int] = None
     chat_id: Optional[int] = None
     temp_message_id: Optional[str] = None  # Thêm temp_message_id từ frontend
+    timeout_seconds: Optional[float] = None  # Ghi đè deadline của request (bị giới hạn bởi MIN/MAX)
+    run_async: bool = False  # Chạy nền, trả về job_id ngay
+    priority: Optional[int] = 0  # 0-9, lớn hơn được xử lý trước (chỉ dùng khi run_async)
+    notify: bool = False  # Gửi kết quả qua notifications khi job xong
+    response_mode: ResponseMode = ResponseMode.COMPACT
 
 class ChatResponse(BaseModel):
     response: str
     data: Optional[Dict[str, Any]] = None  # user_message_id và temp_message_id sẽ nằm trong data
 
 
+# =========================
+# ======= TTL Cache =======
+# =========================
+
+class TTLCache:
+    """Cache trong bộ nhớ có TTL và giới hạn số phần tử (dùng được từ nhiều thread)"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._items: Dict[Any, Any] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, pop: bool = False):
+        with self._lock:
+            item = self._items.pop(key, None) if pop else self._items.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                self._items.pop(key, None)
+                return None
+            return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            # Bỏ phần tử cũ nhất khi vượt giới hạn
+            while len(self._items) > self.max_entries:
+                self._items.pop(next(iter(self._items)))
+
+    def invalidate(self, predicate: Callable[[Any], bool]):
+        with self._lock:
+            for key in [k for k in self._items if predicate(k)]:
+                del self._items[key]
+
+
+# =========================
+# ===== Token Usage =======
+# =========================
+
+class RequestUsage:
+    """Cộng dồn token của mọi lần gọi generate_content trong một request"""
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+        self.stages = []  # Chi tiết từng lần gọi model (initial, loop, evaluate)
+
+    def add(self, response, stage: str):
+        metadata = getattr(response, "usage_metadata", None)
+        prompt_tokens = getattr(metadata, "prompt_token_count", 0) or 0
+        completion_tokens = getattr(metadata, "candidates_token_count", 0) or 0
+        total_tokens = getattr(metadata, "total_token_count", 0) or (prompt_tokens + completion_tokens)
+
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.total_tokens += total_tokens
+        self.stages.append({
+            "stage": stage,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens
+        })
+
+    def budget_exceeded(self) -> bool:
+        return MAX_TOKENS_PER_REQUEST > 0 and self.total_tokens >= MAX_TOKENS_PER_REQUEST
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+            "model_calls": len(self.stages),
+            "stages": self.stages
+        }
+
+
+class UsageStore:
+    """Tổng hợp token usage trong bộ nhớ theo user và theo chat_id"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.by_user: Dict[str, Dict[str, int]] = {}
+        self.by_chat: Dict[str, Dict[str, int]] = {}
+
+    @staticmethod
+    def _accumulate(bucket: Dict[str, Dict[str, int]], key: str, usage: RequestUsage):
+        # Đưa key lên cuối (mới dùng gần nhất), bỏ key lâu không dùng nhất khi vượt giới hạn
+        totals = bucket.pop(key, None) or {
+            "requests": 0,
+            "model_calls": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0
+        }
+        bucket[key] = totals
+        while len(bucket) > USAGE_MAX_KEYS:
+            bucket.pop(next(iter(bucket)))
+        totals["requests"] += 1
+        totals["model_calls"] += len(usage.stages)
+        totals["prompt_tokens"] += usage.prompt_tokens
+        totals["completion_tokens"] += usage.completion_tokens
+        totals["total_tokens"] += usage.total_tokens
+
+    def record(self, user_key: str, chat_id: Optional[int], usage: RequestUsage):
+        with self._lock:
+            self._accumulate(self.by_user, user_key, usage)
+            if chat_id:
+                self._accumulate(self.by_chat, str(chat_id), usage)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "exported_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "by_user": {k: dict(v) for k, v in self.by_user.items()},
+                "by_chat": {k: dict(v) for k, v in self.by_chat.items()}
+            }
+
+    def export(self, path: str):
+        snapshot = self.snapshot()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, indent=2, ensure_ascii=False)
+
+
+usage_store = UsageStore()
+
+
+# user_id đã được backend xác thực theo token hash (0 = tra cứu lỗi, cache ngắn hơn)
+token_user_cache = TTLCache(TOKEN_USER_CACHE_TTL_SECONDS, TOKEN_USER_CACHE_MAX_ENTRIES)
+
+
+def get_token_key(token: str) -> str:
+    """Hash của token, dùng làm khóa sở hữu (không lưu token gốc)"""
+    return "token:" + hashlib.sha256(token.encode("utf-8")).hexdigest()[:16]
+
+
+def resolve_token_user_id(token: str) -> Optional[int]:
+    """Lấy user_id của token qua /users/profile (backend xác thực token), có cache"""
+    token_key = get_token_key(token)
+    cached = token_user_cache.get(token_key)
+    if cached is not None:
+        return cached or None
+    try:
+        profile = call_backend_api(
+            endpoint="/users/profile",
+            method="POST",
+            data={},
+            token=token,
+            timeout=TOKEN_USER_LOOKUP_TIMEOUT_SECONDS
+        )
+        user_id = profile.get("id") if profile else None
+    except Exception as e:
+        print(f"Error resolving token user: {str(e)}")
+        # Backend lỗi: nhớ kết quả một lúc để không request nào cũng phải chờ lại
+        token_user_cache.set(token_key, 0, ttl=TOKEN_USER_FAILURE_TTL_SECONDS)
+        return None
+    token_user_cache.set(token_key, user_id or 0)
+    return user_id
+
+
+def get_user_key(token: str) -> str:
+    """Khóa theo user đã xác thực từ token (usage, chủ job), nếu không được thì hash của token"""
+    user_id = resolve_token_user_id(token)
+    if user_id:
+        return f"user:{user_id}"
+    return get_token_key(token)
+
+
+async def generate_with_usage(
+    usage: RequestUsage,
+    stage: str,
+    *args,
+    timeout: Optional[float] = None,
+    on_text: Optional[Callable[[str], Awaitable[None]]] = None,
+    **kwargs
+):
+    """Gọi model.generate_content trong thread riêng (không chặn event loop) và ghi nhận token usage.
+    Nếu có on_text thì dùng stream=True và đẩy từng đoạn text ngay khi nhận được."""
+    if timeout is not None:
+        kwargs["request_options"] = {"timeout": timeout}
+
+    if on_text is None:
+        response = await asyncio.to_thread(model.generate_content, *args, **kwargs)
+    else:
+        loop = asyncio.get_running_loop()
+
+        def generate_stream():
+            response = model.generate_content(*args, stream=True, **kwargs)
+            streamed_text = ""
+            for chunk in response:
+                if not chunk.candidates:
+                    continue
+                for part in chunk.candidates[0].content.parts:
+                    if not part.text:
+                        continue
+                    streamed_text += part.text
+                    # Text dạng JSON tool_call (xem try_parse_tool_from_text) không gửi cho client
+                    if streamed_text.lstrip().startswith(("{", "```")):
+                        continue
+                    asyncio.run_coroutine_threadsafe(on_text(part.text), loop).result()
+            return response
+
+        response = await asyncio.to_thread(generate_stream)
+
+    usage.add(response, stage)
+    return response
+
+
+async def export_usage_periodically():
+    """Định kỳ ghi thống kê token ra file"""
+    while True:
+        await asyncio.sleep(USAGE_EXPORT_INTERVAL)
+        try:
+            await asyncio.to_thread(usage_store.export, USAGE_EXPORT_PATH)
+        except Exception as e:
+            print(f"Error exporting usage stats: {str(e)}")
+
+
+# Task ghi nhận usage đang chạy nền
+usage_tasks = set()
+
+def record_usage_in_background(token: str, chat_id: Optional[int], usage: RequestUsage):
+    """Ghi nhận usage sau khi trả response: việc tra user qua backend không nằm trên đường phản hồi"""
+    async def run():
+        try:
+            usage_store.record(await asyncio.to_thread(get_user_key, token), chat_id, usage)
+        except Exception as e:
+            print(f"Error recording usage: {str(e)}")
+
+    task = asyncio.create_task(run())
+    usage_tasks.add(task)
+    task.add_done_callback(usage_tasks.discard)
+
+
+# =========================
+# ======= Deadline ========
+# =========================
+
+class Deadline:
+    """Deadline của một request, chia phần thời gian còn lại cho các lần gọi model/backend"""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def for_request(cls, requested: Optional[float]) -> "Deadline":
+        seconds = requested or CHAT_DEADLINE_SECONDS
+        return cls(min(max(seconds, MIN_CHAT_DEADLINE_SECONDS), MAX_CHAT_DEADLINE_SECONDS))
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, floor: float = 0.5) -> float:
+        """Timeout cho lần gọi tiếp theo; floor để các bước bắt buộc (lưu tin nhắn) vẫn có thời gian chạy"""
+        return max(self.remaining(), floor)
+
+
+# =========================
+# ====== Profiling ========
+# =========================
+
+# Cấu hình có thể thay đổi lúc chạy qua POST /debug/profiling
+profiling_config = {
+    "sample_rate": float(os.getenv("PROFILE_SAMPLE_RATE", "0")),  # Tỉ lệ request được profile (0-1)
+    "interval": float(os.getenv("PROFILE_INTERVAL", "0.005")),  # Chu kỳ lấy mẫu stack (giây)
+    "active": False,  # Chỉ profile một request tại một thời điểm
+    "captured": 0
+}
+
+# Thống kê độ trễ của event loop
+loop_stats = {
+    "samples": 0,
+    "last_lag_ms": 0.0,
+    "max_lag_ms": 0.0,
+    "slow_callbacks": 0
+}
+
+
+class StackSampler:
+    """Lấy mẫu stack của mọi thread (event loop và các worker của asyncio.to_thread, nơi chạy
+    lời gọi Gemini/backend) và ghi ra định dạng folded (flamegraph.pl, speedscope).
+    Mỗi stack bắt đầu bằng tên thread để lọc trong flamegraph."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def _is_idle_worker(frame) -> bool:
+        # Worker của ThreadPoolExecutor đang chờ việc: frame trong cùng là _worker (đang block ở queue.get)
+        code = frame.f_code
+        return code.co_name == "_worker" and code.co_filename.endswith(os.path.join("concurrent", "futures", "thread.py"))
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or self._is_idle_worker(frame):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if stack:
+                    stack.append(names.get(thread_id, str(thread_id)))
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Báo thread lấy mẫu dừng, không chờ (an toàn khi gọi trên event loop)"""
+        self._stop.set()
+
+    def write(self, path: str):
+        """Chờ thread lấy mẫu kết thúc rồi ghi file; gọi qua asyncio.to_thread"""
+        self._thread.join()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.items():
+                f.write(f"{stack} {count}\n")
+
+
+def is_admin_secret(secret: Optional[str]) -> bool:
+    if not (PROFILE_ADMIN_SECRET and secret):
+        return False
+    # So sánh bytes: compare_digest báo TypeError với str không phải ASCII (header được decode latin-1)
+    return hmac.compare_digest(secret.encode("utf-8"), PROFILE_ADMIN_SECRET.encode("utf-8"))
+
+
+def require_admin_secret(secret: Optional[str]):
+    if not is_admin_secret(secret):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+def should_profile(request: Request) -> bool:
+    if profiling_config["active"] or request.url.path.startswith("/debug"):
+        return False
+    if is_admin_secret(request.headers.get("X-Debug-Profile")):
+        return True
+    return random.random() < profiling_config["sample_rate"]
+
+
+async def monitor_event_loop_lag():
+    """Đo độ trễ event loop: thời gian sleep thực tế vượt quá thời gian yêu cầu"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(time.perf_counter() - started - LOOP_LAG_INTERVAL, 0.0)
+        loop_stats["samples"] += 1
+        loop_stats["last_lag_ms"] = round(lag * 1000, 2)
+        loop_stats["max_lag_ms"] = max(loop_stats["max_lag_ms"], loop_stats["last_lag_ms"])
+        if lag >= LOOP_LAG_THRESHOLD:
+            loop_stats["slow_callbacks"] += 1
+
+
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    """Profile request theo tỉ lệ lấy mẫu hoặc khi có header X-Debug-Profile hợp lệ"""
+    if not should_profile(request):
+        return await call_next(request)
+
+    profiling_config["active"] = True
+    sampler = StackSampler(profiling_config["interval"])
+    started = time.perf_counter()
+    sampler.start()
+    try:
+        response = await call_next(request)
+    finally:
+        sampler.stop()
+        profiling_config["active"] = False
+
+    profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.url.path.strip('/').replace('/', '_')}-{int((time.perf_counter() - started) * 1000)}ms"
+    try:
+        await asyncio.to_thread(sampler.write, os.path.join(PROFILE_DIR, f"{profile_id}.folded"))
+        profiling_config["captured"] += 1
+        response.headers["X-Profile-Id"] = profile_id
+    except Exception as e:
+        print(f"Error writing profile: {str(e)}")
+    return response
+
+
 # =========================
 # ===== Helper Func =======
 # =========================
@@ -260,9 +862,10 @@ def get_headers(token: Optional[str] = None) -> Dict[str, str]:
         headers["Authorization"] = f"Bearer {token}"  # để backend dùng nếu muốn
     return headers
 
-def call_backend_api(endpoint: str, method: str, data: Dict[str, Any], token: Optional[str] = None) -> Dict[str, Any]:
+def call_backend_api(endpoint: str, method: str, data: Dict[str, Any], token: Optional[str] = None, timeout: Optional[float] = None) -> Dict[str, Any]:
     """Gọi API đến backend"""
     try:
+        timeout = timeout if timeout is not None else BACKEND_TIMEOUT_SECONDS
         url = f"{BACKEND_URL}{endpoint}"
         headers = get_headers(token)
         cookies = {"Authentication": token} if token else {}
@@ -270,9 +873,9 @@ def call_backend_api(endpoint: str, method: str, data: Dict[str, Any], token: Op
         print(cookies, "cookies")
 
         if method.upper() == "POST":
-            response = requests.post(url, headers=headers, cookies=cookies, json=data)
+            response = http_session.post(url, headers=headers, cookies=cookies, json=data, timeout=timeout)
         elif method.upper() == "GET":
-            response = requests.get(url, headers=headers, cookies=cookies, params=data)
+            response = http_session.get(url, headers=headers, cookies=cookies, params=data, timeout=timeout)
         else:
             raise HTTPException(status_code=400, detail="Method not supported")
         
@@ -293,7 +896,7 @@ def get_token_from_header(authorization: Optional[str] = Header(None)) -> Option
     except ValueError:
         return None
 
-def evaluate_api_response(api_calls: list, api_responses: list, last_response: dict, is_confirmation: bool = False) -> str:
+async def evaluate_api_response(api_calls: list, api_responses: list, last_response: dict, is_confirmation: bool = False, usage: Optional[RequestUsage] = None, timeout: Optional[float] = None) -> str:
     """Đánh giá kết quả từ API calls và tạo message phù hợp"""
     try:
         # Tạo prompt cho Gemini để đánh giá kết quả
@@ -314,13 +917,13 @@ def evaluate_api_response(api_calls: list, api_responses: list, last_response: d
         """
         
         # Gọi Gemini để tạo message
-        response = model.generate_content(prompt)
+        response = await generate_with_usage(usage or RequestUsage(), "evaluate", prompt, timeout=timeout)
         return response.text.strip()
     except Exception as e:
         # Nếu có lỗi trong quá trình đánh giá, trả về message mặc định
         return "Tôi đã hoàn thành yêu cầu của bạn. Bạn có cần tôi giúp gì thêm không?"
 
-async def save_message(content: str, sender: Sender, chat_id: Optional[int] = None, token: Optional[str] = None) -> Dict[str, Any]:
+async def save_message(content: str, sender: Sender, chat_id: Optional[int] = None, token: Optional[str] = None, timeout: Optional[float] = None) -> Dict[str, Any]:
     """Lưu tin nhắn vào database"""
     try:
         # Kiểm tra token
@@ -342,11 +945,13 @@ async def save_message(content: str, sender: Sender, chat_id: Optional[int] = No
 
         # Tạo tin nhắn mới
         try:
-            response = call_backend_api(
+            response = await asyncio.to_thread(
+                call_backend_api,
                 endpoint="/messages/create",
                 method="POST",
                 data=data,
-                token=token
+                token=token,
+                timeout=timeout
             )
             return response
         except requests.exceptions.HTTPError as api_error:
@@ -388,7 +993,7 @@ def convert_proto_to_dict(obj):
     else:
         return obj
 
-async def execute_tool(tool_name: str, tool_args: Dict[str, Any], token: str) -> Dict[str, Any]:
+async def execute_tool(tool_name: str, tool_args: Dict[str, Any], token: str, timeout: Optional[float] = None) -> Dict[str, Any]:
     """Thực thi tool dựa trên tên và tham số"""
     try:
         # Convert protobuf objects to Python dict
@@ -408,46 +1013,37 @@ async def execute_tool(tool_name: str, tool_args: Dict[str, Any], token: str) ->
                     content=converted_args["content"],
                     sender=Sender(converted_args["sender"]),
                     chat_id=converted_args.get("chatId"),
-                    token=token
+                    token=token,
+                    timeout=timeout
                 )
                 print("create_message response:", response)
                 return response
             elif tool_name == "find_messages":
-                response = call_backend_api(
+                response = await asyncio.to_thread(
+                    call_backend_api,
                     endpoint="/messages/find-messages",
                     method="POST",
                     data=converted_args,
-                    token=token
+                    token=token,
+                    timeout=timeout
                 )
                 print("find_messages response:", response)
                 return response
             elif tool_name == "find_classes":
-                converted_args["fetchAll"] = True
-                
-                if "month" in converted_args and "year" in converted_args:
-                    response = call_backend_api(
-                        endpoint="/classes/calendar",
-                        method="POST",
-                        data=converted_args,
-                        token=token
-                    )
-                else:
-                    response = call_backend_api(
-                        endpoint="/classes/find-classes",
-                        method="POST",
-                        data=converted_args,
-                        token=token
-                    )
+                response = await asyncio.to_thread(find_classes, prepare_find_classes_args(converted_args), token, timeout=timeout)
                 print("find_classes response:", response)
                 return response
             elif tool_name == "create_student":
-                response = call_backend_api(
+                response = await asyncio.to_thread(
+                    call_backend_api,
                     endpoint="/students/create",
                     method="POST",
                     data=converted_args,
-                    token=token
+                    token=token,
+                    timeout=timeout
                 )
                 print("create_student response:", response)
+                invalidate_class_cache(token)
                 return response
             elif tool_name == "create_class":
                 # Validate required fields
@@ -493,13 +1089,16 @@ async def execute_tool(tool_name: str, tool_args: Dict[str, Any], token: str) ->
                         )
 
                 try:
-                    response = call_backend_api(
+                    response = await asyncio.to_thread(
+                        call_backend_api,
                         endpoint="/classes/create",
                         method="POST",
                         data=converted_args,
-                        token=token
+                        token=token,
+                        timeout=timeout
                     )
                     print("create_class response:", response)
+                    invalidate_class_cache(token)
                     return response
                 except Exception as e:
                     print("Error in create_class API call:", str(e))
@@ -514,6 +1113,92 @@ async def execute_tool(tool_name: str, tool_args: Dict[str, Any], token: str) ->
         print(f"Error in execute_tool for {tool_name}:", str(e))
         raise HTTPException(status_code=500, detail=f"Lỗi khi thực thi tool {tool_name}: {str(e)}")
 
+def summarize_api_response(result: Any) -> Dict[str, Any]:
+    """Tóm tắt kết quả backend: tổng số, số bản ghi trả về và một số id"""
+    summary = {}
+    items = None
+    if isinstance(result, dict):
+        if "id" in result:
+            summary["id"] = result["id"]
+        if "total" in result:
+            summary["total"] = result["total"]
+        items = result.get("data")
+    elif isinstance(result, list):
+        items = result
+    if isinstance(items, list):
+        summary["count"] = len(items)
+        summary["ids"] = [item["id"] for item in items[:SUMMARY_MAX_IDS] if isinstance(item, dict) and "id" in item]
+    return summary
+
+def shape_api_responses(api_responses: list, mode: ResponseMode) -> Dict[str, Any]:
+    """api_responses đầy đủ khi mode=full, mặc định chỉ trả về bản tóm tắt"""
+    if mode == ResponseMode.FULL:
+        return {"api_responses": convert_proto_to_dict(api_responses)}
+    return {"api_summaries": [summarize_api_response(result) for result in api_responses]}
+
+# =========================
+# ====== Warm Cache =======
+# =========================
+
+# Context đã dựng sẵn theo (owner, chat_id) kèm thời điểm bắt đầu warm, dùng một lần cho lượt chat tiếp theo
+context_cache = TTLCache(WARM_CACHE_TTL_SECONDS, WARM_CACHE_MAX_ENTRIES)
+# Thời điểm lượt chat gần nhất đã lưu tin nhắn theo (owner, chat_id): context warm trước mốc này đã cũ
+chat_turn_cache = TTLCache(WARM_CACHE_TTL_SECONDS, WARM_CACHE_MAX_ENTRIES)
+# Danh sách lớp học do /chat/warm tải trước theo (owner, endpoint, args), dùng một lần
+class_cache = TTLCache(WARM_CACHE_TTL_SECONDS, WARM_CACHE_MAX_ENTRIES)
+# Lịch sử tin nhắn theo (owner, chat_id), cập nhật dần bằng sinceId
+history_cache = TTLCache(HISTORY_CACHE_TTL_SECONDS, WARM_CACHE_MAX_ENTRIES)
+
+
+def prepare_find_classes_args(args: Dict[str, Any]) -> Dict[str, Any]:
+    """Tham số mặc định cho find_classes: danh sách lớp phân trang theo cursor thay vì lấy toàn bộ"""
+    if args.get("learningDate") or ("month" in args and "year" in args):
+        # Lọc theo ngày/lịch tháng không hỗ trợ cursor: giữ cách lấy toàn bộ như trước
+        if "rowPerPage" not in args and "page" not in args:
+            args.setdefault("fetchAll", True)
+        return args
+    if not args.get("fetchAll"):
+        args.setdefault("rowPerPage", FIND_CLASSES_PAGE_SIZE)
+        if "page" not in args:
+            args.setdefault("cursor", 0)  # Trang đầu của keyset pagination, backend trả về nextCursor
+    return args
+
+def get_find_classes_endpoint(data: Dict[str, Any]) -> str:
+    return "/classes/calendar" if "month" in data and "year" in data else "/classes/find-classes"
+
+def get_class_cache_key(data: Dict[str, Any], token: str):
+    return (get_token_key(token), get_find_classes_endpoint(data), json.dumps(data, sort_keys=True, ensure_ascii=False))
+
+def find_classes(data: Dict[str, Any], token: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+    """Gọi find-classes/calendar; dùng kết quả /chat/warm đã tải trước (một lần) nếu cùng tham số"""
+    prefetched = class_cache.get(get_class_cache_key(data, token), pop=True)
+    if prefetched is not None:
+        return prefetched
+    return call_backend_api(
+        endpoint=get_find_classes_endpoint(data),
+        method="POST",
+        data=data,
+        token=token,
+        timeout=timeout
+    )
+
+def prefetch_classes(data: Dict[str, Any], token: str):
+    """Tải trước danh sách lớp học cho lần find_classes đầu tiên"""
+    response = call_backend_api(
+        endpoint=get_find_classes_endpoint(data),
+        method="POST",
+        data=data,
+        token=token
+    )
+    class_cache.set(get_class_cache_key(data, token), response)
+
+
+def invalidate_class_cache(token: str):
+    """Bỏ danh sách lớp học đã tải trước của user sau khi dữ liệu thay đổi"""
+    owner = get_token_key(token)
+    class_cache.invalidate(lambda key: key[0] == owner)
+
+
 # =========================
 # ======= Chat API ========
 # =========================
@@ -533,132 +1218,238 @@ def try_parse_tool_from_text(text: str):
         pass
     return None
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest, authorization: Optional[str] = Header(None)):
-    """Endpoint xử lý chat với người dùng"""
-    try:
-        token = authorization.split(" ")[1] if authorization else None
-        if not token:
-            raise HTTPException(status_code=401, detail="Unauthorized")
+def fetch_chat_history(chat_id: int, token: str, timeout: Optional[float] = None, since_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Lấy lịch sử tin nhắn của một cuộc trò chuyện (chỉ tin nhắn sau since_id nếu có)"""
+    data = {"chatId": chat_id, "fetchAll": True}
+    if since_id:
+        data["sinceId"] = since_id
+    history_response = call_backend_api(
+        endpoint="/messages/find-messages",
+        method="POST",
+        data=data,
+        token=token,
+        timeout=timeout
+    )
+    if history_response and "data" in history_response:
+        return history_response["data"]
+    return []
+
+def load_chat_history(chat_id: int, token: str, timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+    """Lịch sử chat từ cache, chỉ lấy thêm các tin nhắn mới từ backend"""
+    key = (get_token_key(token), chat_id)
+    cached = history_cache.get(key) or []
+    since_id = cached[-1]["id"] if cached else None
+    history = cached + fetch_chat_history(chat_id, token, timeout=timeout, since_id=since_id)
+    history_cache.set(key, history)
+    return history
+
+def build_chat_context(chat_history: List[Dict[str, Any]]) -> List[glm.Content]:
+    """Dựng context cho model: system prompt + lịch sử chat"""
+    # System prompt ở đầu messages với role là model
+    messages = [system_prompt_content]
+    if chat_history:
+        # Thêm lịch sử chat vào messages để bot có context
+        messages.append(
+            glm.Content(
+                role="model",
+                parts=[glm.Part(text="Đây là lịch sử chat trước đó:")]
+            )
+        )
+        # Thêm từng tin nhắn vào context
+        for msg in chat_history:
+            # Map role: USER -> user, BOT -> model
+            role = "user" if msg["sender"] == "USER" else "model"
+            messages.append(
+                glm.Content(
+                    role=role,
+                    parts=[glm.Part(text=msg["content"])]
+                )
+            )
+    return messages
+
+async def prepare_chat_context(chat_id: Optional[int], token: str, deadline: Deadline) -> List[glm.Content]:
+    """Lấy lịch sử (nếu có chat_id) và dựng context cho model"""
+    # Context đã được /chat/warm chuẩn bị sẵn
+    if chat_id:
+        owner = get_token_key(token)
+        warm_task = warm_tasks.get(("history", owner, chat_id))
+        if warm_task:
+            # Đang warm: chờ kết quả thay vì lấy lịch sử song song; quá hạn thì hủy để không lưu context cũ
+            await asyncio.wait([warm_task], timeout=deadline.timeout())
+            if not warm_task.done():
+                warm_task.cancel()
+        cached = context_cache.get((owner, chat_id), pop=True)
+        if cached is not None:
+            warm_started_at, context = cached
+            last_turn_at = chat_turn_cache.get((owner, chat_id))
+            # Có lượt chat lưu tin nhắn sau khi bắt đầu warm thì context thiếu lượt đó: bỏ đi
+            if last_turn_at is None or last_turn_at < warm_started_at:
+                return context
+
+    chat_history = []
+    if chat_id:
+        try:
+            chat_history = await asyncio.to_thread(load_chat_history, chat_id, token, timeout=deadline.timeout())
+        except Exception as e:
+            # Nếu có lỗi khi lấy lịch sử, chỉ dùng tin nhắn mới
+            print(f"Error fetching chat history: {str(e)}")
+    return build_chat_context(chat_history)
+
+async def run_chat_turn(
+    request: ChatRequest,
+    token: str,
+    context: List[glm.Content],
+    deadline: Deadline,
+    on_event: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+    stream_text: bool = False,
+    check_cancelled: Optional[Callable[[], None]] = None
+) -> ChatResponse:
+    """Xử lý một lượt chat trên context đã chuẩn bị (context không bị thay đổi).
+    stream_text: stream text của lần gọi model đầu tiên qua on_event; response cuối cùng
+    (có thể đã qua evaluate_api_response) thay thế các đoạn text đã gửi
+    check_cancelled: gọi trước mỗi lần gọi model/backend, raise để dừng lượt chat"""
+
+    def before_step():
+        if check_cancelled:
+            check_cancelled()
+
+    async def emit(event_type: str, **payload):
+        if on_event:
+            await on_event({"type": event_type, **payload})
+
+    async def emit_text(text: str):
+        await emit("text", text=text)
+
+    on_text = emit_text if on_event and stream_text else None
+
+    # Khởi tạo biến theo dõi
+    api_calls = []
+    api_responses = []
+    process_query = True
+    function_call_count = 0
+    user_chat_id = request.chat_id  # Lưu chat_id từ request
+    usage = RequestUsage()  # Token usage của request này
+    budget_exceeded = False
+    deadline_exceeded = False
+
+    # Context + tin nhắn mới của user
+    messages = list(context)
+    messages.append(
+        glm.Content(
+            role="user",
+            parts=[glm.Part(text=request.message)]
+        )
+    )
 
-        # Khởi tạo biến theo dõi
-        api_calls = []
-        api_responses = []
-        process_query = True
-        function_call_count = 0
-        user_chat_id = request.chat_id  # Lưu chat_id từ request
-        chat_history = []  # Lưu lịch sử chat
+    try:
+        # Cấu hình generation
+        generation_config = {
+            "temperature": 0.7,
+            "top_p": 0.8,
+            "top_k": 40,
+            "max_output_tokens": 2048,
+        }
 
-        try:
-            # Nếu có chat_id, lấy lịch sử chat trước
-            if user_chat_id:
-                try:
-                    history_response = call_backend_api(
-                        endpoint="/messages/find-messages",
-                        method="POST",
-                        data={"chatId": user_chat_id, "fetchAll": True},
-                        token=token
-                    )
-                    if history_response and "data" in history_response:
-                        chat_history = history_response["data"]
-                        # Thêm lịch sử chat vào messages để bot có context
-                        messages = [
-                            glm.Content(
-                                role="model",
-                                parts=[glm.Part(text="Đây là lịch sử chat trước đó:")]
-                            )
-                        ]
-                        # Thêm từng tin nhắn vào context
-                        for msg in chat_history:
-                            # Map role: USER -> user, BOT -> model
-                            role = "user" if msg["sender"] == "USER" else "model"
-                            messages.append(
-                                glm.Content(
-                                    role=role,
-                                    parts=[glm.Part(text=msg["content"])]
+        before_step()
+        response = await generate_with_usage(
+            usage,
+            "initial",
+            contents=messages,
+            generation_config=generation_config,
+            timeout=deadline.timeout(),
+            on_text=on_text,
+        )
+        response_streamed = on_text is not None
+
+        print("Initial response:", response)
+
+        final_response = None
+
+        # Bắt đầu xử lý loop
+        while process_query:
+            try:
+                assistant_content = []
+                has_function_call = False
+
+                for content in response.candidates[0].content.parts:
+                    # Hết thời gian: không gọi thêm tool nào nữa
+                    if deadline.expired():
+                        deadline_exceeded = True
+                        break
+                    try:
+                        # ✅ ƯU TIÊN function_call nếu có
+                        if hasattr(content, 'function_call') and content.function_call:
+                            has_function_call = True
+                            function_call_count += 1
+                            tool_call = content.function_call
+                            print(f"Function call #{function_call_count}: {tool_call.name}")
+
+                            try:
+                                args_dict = dict(tool_call.args)
+                                print("Function call args:", args_dict)
+                                await emit("tool_call", tool=tool_call.name, args=convert_proto_to_dict(args_dict))
+                                before_step()
+                                result = await execute_tool(tool_call.name, args_dict, token, timeout=deadline.timeout())
+                                print("Function call result:", result)
+                                await emit("tool_result", tool=tool_call.name)
+
+                                api_calls.append({
+                                    "tool": tool_call.name,
+                                    "args": args_dict
+                                })
+                                api_responses.append(result)
+
+                                messages.append(
+                                    glm.Content(
+                                        role="model",
+                                        parts=[glm.Part(
+                                            function_call=glm.FunctionCall(
+                                                name=tool_call.name,
+                                                args=args_dict
+                                            )
+                                        )]
+                                    )
                                 )
-                            )
-                        # Thêm tin nhắn mới của user
-                        messages.append(
-                            glm.Content(
-                                role="user",
-                                parts=[glm.Part(text=request.message)]
-                            )
-                        )
-                    else:
-                        # Nếu không lấy được lịch sử, chỉ thêm tin nhắn mới
-                        messages = [
-                            glm.Content(
-                                role="user",
-                                parts=[glm.Part(text=request.message)]
-                            )
-                        ]
-                except Exception as e:
-                    print(f"Error fetching chat history: {str(e)}")
-                    # Nếu có lỗi khi lấy lịch sử, chỉ thêm tin nhắn mới
-                    messages = [
-                        glm.Content(
-                            role="user",
-                            parts=[glm.Part(text=request.message)]
-                        )
-                    ]
-            else:
-                # Nếu không có chat_id, chỉ thêm tin nhắn mới
-                messages = [
-                    glm.Content(
-                        role="user",
-                        parts=[glm.Part(text=request.message)]
-                    )
-                ]
-            
-            # Đọc system prompt
-            with open("prompts/system_prompt.txt", "r", encoding="utf-8") as f:
-                system_prompt = f.read()
-
-            # Thêm system prompt vào đầu messages với role là model
-            messages.insert(0, glm.Content(
-                role="model",
-                parts=[glm.Part(text=system_prompt)]
-            ))
-
-            # Cấu hình generation
-            generation_config = {
-                "temperature": 0.7,
-                "top_p": 0.8,
-                "top_k": 40,
-                "max_output_tokens": 2048,
-            }
-
-            response = model.generate_content(
-                contents=messages,
-                generation_config=generation_config,
-            )
 
-            print("Initial response:", response)
+                                messages.append(
+                                    glm.Content(
+                                        role="user",
+                                        parts=[glm.Part(
+                                            function_response=glm.FunctionResponse(
+                                                name=tool_call.name,
+                                                response={"content": result}
+                                            )
+                                        )]
+                                    )
+                                )
 
-            final_response = None
+                            except Exception as e:
+                                print(f"Error executing tool {tool_call.name}:", str(e))
+                                raise
 
-            # Bắt đầu xử lý loop
-            while process_query:
-                try:
-                    assistant_content = []
-                    has_function_call = False
+                        elif content.text:
+                            # ✨ Thử parse text thành tool_call JSON
+                            tool_call_raw = try_parse_tool_from_text(content.text)
 
-                    for content in response.candidates[0].content.parts:
-                        try:
-                            # ✅ ƯU TIÊN function_call nếu có
-                            if hasattr(content, 'function_call') and content.function_call:
+                            if tool_call_raw:
                                 has_function_call = True
                                 function_call_count += 1
-                                tool_call = content.function_call
-                                print(f"Function call #{function_call_count}: {tool_call.name}")
+                                print(f"Function call #{function_call_count} (from text): {tool_call_raw['name']}")
 
                                 try:
+                                    tool_call = glm.FunctionCall(
+                                        name=tool_call_raw["name"],
+                                        args=tool_call_raw["args"]
+                                    )
+
                                     args_dict = dict(tool_call.args)
-                                    print("Function call args:", args_dict)
-                                    result = await execute_tool(tool_call.name, args_dict, token)
-                                    print("Function call result:", result)
-                                    
+                                    print("Function call args (from text):", args_dict)
+                                    await emit("tool_call", tool=tool_call.name, args=convert_proto_to_dict(args_dict))
+                                    before_step()
+                                    result = await execute_tool(tool_call.name, args_dict, token, timeout=deadline.timeout())
+                                    print("Function call result (from text):", result)
+                                    await emit("tool_result", tool=tool_call.name)
+
                                     api_calls.append({
                                         "tool": tool_call.name,
                                         "args": args_dict
@@ -668,12 +1459,7 @@ async def chat(request: ChatRequest, authorization: Optional[str] = Header(None)
                                     messages.append(
                                         glm.Content(
                                             role="model",
-                                            parts=[glm.Part(
-                                                function_call=glm.FunctionCall(
-                                                    name=tool_call.name,
-                                                    args=args_dict
-                                                )
-                                            )]
+                                            parts=[glm.Part(function_call=tool_call)]
                                         )
                                     )
 
@@ -690,145 +1476,175 @@ async def chat(request: ChatRequest, authorization: Optional[str] = Header(None)
                                     )
 
                                 except Exception as e:
-                                    print(f"Error executing tool {tool_call.name}:", str(e))
+                                    print(f"Error executing tool {tool_call_raw['name']} (from text):", str(e))
                                     raise
 
-                            elif content.text:
-                                # ✨ Thử parse text thành tool_call JSON
-                                tool_call_raw = try_parse_tool_from_text(content.text)
-
-                                if tool_call_raw:
-                                    has_function_call = True
-                                    function_call_count += 1
-                                    print(f"Function call #{function_call_count} (from text): {tool_call_raw['name']}")
-
-                                    try:
-                                        tool_call = glm.FunctionCall(
-                                            name=tool_call_raw["name"],
-                                            args=tool_call_raw["args"]
-                                        )
-
-                                        args_dict = dict(tool_call.args)
-                                        print("Function call args (from text):", args_dict)
-                                        result = await execute_tool(tool_call.name, args_dict, token)
-                                        print("Function call result (from text):", result)
-
-                                        api_calls.append({
-                                            "tool": tool_call.name,
-                                            "args": args_dict
-                                        })
-                                        api_responses.append(result)
-
-                                        messages.append(
-                                            glm.Content(
-                                                role="model",
-                                                parts=[glm.Part(function_call=tool_call)]
-                                            )
-                                        )
-
-                                        messages.append(
-                                            glm.Content(
-                                                role="user",
-                                                parts=[glm.Part(
-                                                    function_response=glm.FunctionResponse(
-                                                        name=tool_call.name,
-                                                        response={"content": result}
-                                                    )
-                                                )]
-                                            )
-                                        )
-
-                                    except Exception as e:
-                                        print(f"Error executing tool {tool_call_raw['name']} (from text):", str(e))
-                                        raise
-
-                                else:
-                                    assistant_content.append({"type": "text", "text": content.text})
-
-                        except Exception as e:
-                            print(f"Error processing content part:", str(e))
-                            raise
-
-                    if has_function_call:
-                        try:
-                            response = model.generate_content(
-                                contents=messages,
-                                generation_config=generation_config,
-                            )
-                            print("New response in loop:", response)
-                        except Exception as e:
-                            print("Error generating new response:", str(e))
-                            raise
-                    else:
-                        final_response = next((item["text"] for item in assistant_content if item["type"] == "text"), None)
-                        process_query = False
+                            else:
+                                assistant_content.append({"type": "text", "text": content.text})
+                                if not response_streamed:  # Đã stream từng đoạn trong generate_with_usage
+                                    await emit("text", text=content.text)
+
+                    except Exception as e:
+                        print(f"Error processing content part:", str(e))
+                        raise
+
+                if has_function_call and (
+                    usage.budget_exceeded()
+                    or (MAX_FUNCTION_CALLS_PER_REQUEST > 0 and function_call_count >= MAX_FUNCTION_CALLS_PER_REQUEST)
+                ):
+                    # Vượt ngân sách: dừng tool loop, trả về phần trả lời đã có
+                    print(f"Budget exceeded: {usage.total_tokens} tokens, {function_call_count} function calls")
+                    budget_exceeded = True
+                    final_response = next((item["text"] for item in assistant_content if item["type"] == "text"), None)
+                    process_query = False
+                elif has_function_call and (deadline_exceeded or deadline.expired()):
+                    # Hết deadline: dừng tool loop, trả về phần trả lời đã có
+                    print(f"Deadline exceeded after {function_call_count} function calls")
+                    deadline_exceeded = True
+                    final_response = next((item["text"] for item in assistant_content if item["type"] == "text"), None)
+                    process_query = False
+                elif has_function_call:
+                    try:
+                        before_step()
+                        response = await generate_with_usage(
+                            usage,
+                            "loop",
+                            contents=messages,
+                            generation_config=generation_config,
+                            timeout=deadline.timeout(),
+                        )
+                        # Không stream sau khi gọi tool: text này thường bị evaluate_api_response thay thế
+                        response_streamed = False
+                        print("New response in loop:", response)
+                    except Exception as e:
+                        print("Error generating new response:", str(e))
+                        raise
+                else:
+                    final_response = next((item["text"] for item in assistant_content if item["type"] == "text"), None)
+                    process_query = False
 
-                except Exception as e:
-                    print("Error in process_query loop:", str(e))
+            except Exception as e:
+                print("Error in process_query loop:", str(e))
+                if not deadline.expired():
                     raise
-
-            # ✅ Trả về kết quả cuối
-            response_text = final_response or "Xin lỗi, tôi chưa thể xử lý yêu cầu của bạn."
-
-            # Đánh giá API responses và tạo message phù hợp
-            if api_calls and api_responses:
-                evaluated_response = evaluate_api_response(
-                    api_calls=api_calls,
-                    api_responses=api_responses,
-                    last_response={"text": response_text},
-                    is_confirmation=any(call["tool"] in ["create_student", "create_class", "create_message"] for call in api_calls)
+                # Tool/model call bị timeout do hết deadline: trả về phần đã xử lý
+                deadline_exceeded = True
+                process_query = False
+
+        # ✅ Trả về kết quả cuối
+        response_text = final_response or "Xin lỗi, tôi chưa thể xử lý yêu cầu của bạn."
+
+        if deadline_exceeded and not final_response and api_calls:
+            response_text = f"Xin lỗi, yêu cầu mất quá nhiều thời gian nên tôi mới thực hiện được {len(api_calls)} thao tác. Bạn có thể kiểm tra lại và yêu cầu tiếp phần còn lại."
+        elif budget_exceeded and not final_response and api_calls:
+            response_text = f"Xin lỗi, yêu cầu vượt quá giới hạn xử lý nên tôi mới thực hiện được {len(api_calls)} thao tác. Bạn có thể kiểm tra lại và yêu cầu tiếp phần còn lại."
+
+        # Đánh giá API responses và tạo message phù hợp
+        if api_calls and api_responses and not deadline_exceeded and not budget_exceeded:
+            before_step()
+            evaluated_response = await evaluate_api_response(
+                api_calls=api_calls,
+                api_responses=api_responses,
+                last_response={"text": response_text},
+                is_confirmation=any(call["tool"] in ["create_student", "create_class", "create_message"] for call in api_calls),
+                usage=usage,
+                timeout=deadline.timeout()
+            )
+            response_text = evaluated_response
+
+        user_message_id = None  # Mặc định là null
+
+        # Lưu tin nhắn vào database nếu có response từ bot
+        if response_text and response_text != "Xin lỗi, tôi chưa thể xử lý yêu cầu của bạn.":
+            before_step()
+            try:
+                # Lưu tin nhắn của user
+                user_message_response = await save_message(
+                    content=request.message,
+                    sender=Sender.USER,
+                    chat_id=user_chat_id,
+                    token=token,
+                    timeout=deadline.timeout(floor=2)
                 )
-                response_text = evaluated_response
 
-            user_message_id = None  # Mặc định là null
+                # Lấy chat_id từ response nếu chưa có
+                if not user_chat_id and user_message_response:
+                    user_chat_id = user_message_response.get("chatId")
 
-            # Lưu tin nhắn vào database nếu có response từ bot
-            if response_text and response_text != "Xin lỗi, tôi chưa thể xử lý yêu cầu của bạn.":
-                try:
-                    # Lưu tin nhắn của user
-                    user_message_response = await save_message(
-                        content=request.message,
-                        sender=Sender.USER,
+                # Lấy user_message_id từ response
+                if user_message_response:
+                    user_message_id = user_message_response.get("id")
+
+                # Lưu tin nhắn của bot
+                if user_chat_id:
+                    await save_message(
+                        content=response_text,
+                        sender=Sender.BOT,
                         chat_id=user_chat_id,
-                        token=token
+                        token=token,
+                        timeout=deadline.timeout(floor=2)
                     )
+            except Exception as e:
+                print(f"Error saving messages to database: {str(e)}")
+                # Không raise exception ở đây để không ảnh hưởng đến response cho user
+
+            if user_chat_id and user_message_id:
+                chat_turn_cache.set((get_token_key(token), user_chat_id), time.monotonic())
+
+        # ✅ Return response với user_message_id và temp_message_id trong data
+        return ChatResponse(
+            response=response_text,
+            data={
+                "api_calls": convert_proto_to_dict(api_calls),
+                **shape_api_responses(api_responses, request.response_mode),
+                "function_call_count": function_call_count,
+                "chat_id": user_chat_id,
+                "user_message_id": user_message_id,  # Sẽ là null nếu không có response_text
+                "temp_message_id": request.temp_message_id,
+                "usage": usage.to_dict(),
+                "budget_exceeded": budget_exceeded,
+                "deadline_exceeded": deadline_exceeded
+            }
+        )
 
-                    # Lấy chat_id từ response nếu chưa có
-                    if not user_chat_id and user_message_response:
-                        user_chat_id = user_message_response.get("chatId")
-                    
-                    # Lấy user_message_id từ response
-                    if user_message_response:
-                        user_message_id = user_message_response.get("id")
-                    
-                    # Lưu tin nhắn của bot
-                    if user_chat_id:
-                        await save_message(
-                            content=response_text,
-                            sender=Sender.BOT,
-                            chat_id=user_chat_id,
-                            token=token
-                        )
-                except Exception as e:
-                    print(f"Error saving messages to database: {str(e)}")
-                    # Không raise exception ở đây để không ảnh hưởng đến response cho user
+    finally:
+        # Ghi nhận usage kể cả khi request lỗi
+        record_usage_in_background(token, user_chat_id, usage)
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest, response: Response, authorization: Optional[str] = Header(None)):
+    """Endpoint xử lý chat với người dùng"""
+    try:
+        token = authorization.split(" ")[1] if authorization else None
+        if not token:
+            raise HTTPException(status_code=401, detail="Unauthorized")
 
-            # ✅ Return response với user_message_id và temp_message_id trong data
+        # Chế độ chạy nền: xếp hàng và trả về job_id ngay
+        if request.run_async:
+            job = job_manager.submit(ChatJob(request, token, await asyncio.to_thread(get_user_key, token)))
+            response.status_code = 202
             return ChatResponse(
-                response=response_text,
+                response="",
                 data={
-                    "api_calls": convert_proto_to_dict(api_calls),
-                    "api_responses": convert_proto_to_dict(api_responses),
-                    "function_call_count": function_call_count,
-                    "chat_id": user_chat_id,
-                    "user_message_id": user_message_id,  # Sẽ là null nếu không có response_text
+                    "job_id": job.id,
+                    "status": job.status,
                     "temp_message_id": request.temp_message_id
                 }
             )
 
+        deadline = Deadline.for_request(request.timeout_seconds)
+
+        try:
+            context = await prepare_chat_context(request.chat_id, token, deadline)
+            return await run_chat_turn(request, token, context, deadline)
 
         except Exception as e:
             print("Error in chat processing:", str(e))
+            if deadline.expired():
+                raise HTTPException(
+                    status_code=504,
+                    detail="Request deadline exceeded"
+                )
             raise HTTPException(
                 status_code=500,
                 detail=f"Error processing chat: {str(e)}"
@@ -844,6 +1660,523 @@ async def chat(request: ChatRequest, authorization: Optional[str] = Header(None)
             detail=f"Unexpected error: {str(e)}"
         )
 
+# =========================
+# ==== WebSocket Chat =====
+# =========================
+
+# Số phiên WebSocket đang mở trên worker này
+active_ws_sessions = 0
+
+class ChatSession:
+    """Phiên /ws/chat: giữ token, chat_id và context đã dựng trong suốt kết nối"""
+
+    def __init__(self, websocket: WebSocket, token: str, chat_id: Optional[int]):
+        self.websocket = websocket
+        self.token = token
+        self.chat_id = chat_id
+        self.context: List[glm.Content] = []
+        # Hàng đợi gửi có giới hạn: khi client đọc chậm, lượt chat sẽ chờ (backpressure)
+        self.outbox: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.pump_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.pump_task = asyncio.create_task(self.pump())
+
+    def is_closed(self) -> bool:
+        return self.pump_task is None or self.pump_task.done()
+
+    async def send(self, event: Dict[str, Any]):
+        """Đưa event vào hàng đợi gửi; lỗi nếu pump đã dừng để lượt chat không chờ mãi"""
+        if self.is_closed():
+            raise ConnectionError("WebSocket connection closed")
+        try:
+            self.outbox.put_nowait(event)
+            return
+        except asyncio.QueueFull:
+            pass
+        put_task = asyncio.ensure_future(self.outbox.put(event))
+        await asyncio.wait({put_task, self.pump_task}, return_when=asyncio.FIRST_COMPLETED)
+        if not put_task.done():
+            put_task.cancel()
+            raise ConnectionError("WebSocket connection closed")
+
+    async def pump(self):
+        """Đẩy các event trong hàng đợi xuống client, dừng khi gửi lỗi"""
+        try:
+            while True:
+                event = await self.outbox.get()
+                try:
+                    await self.websocket.send_json(event)
+                finally:
+                    self.outbox.task_done()
+        except Exception as e:
+            print("WebSocket send failed:", str(e))
+
+    def remember_turn(self, message: str, response_text: str):
+        """Thêm lượt chat vừa xong vào context, giống lịch sử được lưu ở backend"""
+        self.context.append(glm.Content(role="user", parts=[glm.Part(text=message)]))
+        self.context.append(glm.Content(role="model", parts=[glm.Part(text=response_text)]))
+
+@app.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket, chat_id: Optional[int] = None):
+    """Phiên chat qua WebSocket: xác thực và lấy lịch sử một lần, sau đó chỉ xử lý lượt mới.
+    Event "text" là phần trả lời tạm thời; event "response" cuối lượt là kết quả chính thức."""
+    global active_ws_sessions
+
+    if active_ws_sessions >= WS_MAX_SESSIONS:
+        await websocket.close(code=1013, reason="Too many sessions")
+        return
+
+    active_ws_sessions += 1
+    session = None
+    try:
+        await websocket.accept()
+
+        # Token lấy từ header Authorization hoặc frame đầu tiên {"type": "auth", "token": ...}
+        # (không nhận qua query string vì URL bị ghi vào access log)
+        token = get_token_from_header(websocket.headers.get("authorization"))
+        if not token:
+            try:
+                auth = await asyncio.wait_for(websocket.receive_json(), timeout=WS_AUTH_TIMEOUT_SECONDS)
+                if isinstance(auth, dict) and auth.get("type") == "auth":
+                    token = auth.get("token")
+            except (asyncio.TimeoutError, ValueError, KeyError):
+                token = None
+        if not token:
+            await websocket.close(code=1008, reason="Unauthorized")
+            return
+
+        session = ChatSession(websocket, token, chat_id)
+        session.context = await prepare_chat_context(chat_id, token, Deadline.for_request(None))
+        session.start()
+        await session.send({"type": "ready", "chat_id": session.chat_id})
+
+        while True:
+            # Chờ tin nhắn mới nhưng dừng ngay nếu pump đã chết (không gửi được nữa)
+            receive_task = asyncio.create_task(
+                asyncio.wait_for(websocket.receive_json(), timeout=WS_IDLE_TIMEOUT_SECONDS)
+            )
+            await asyncio.wait({receive_task, session.pump_task}, return_when=asyncio.FIRST_COMPLETED)
+            if not receive_task.done():
+                receive_task.cancel()
+                break
+            try:
+                payload = receive_task.result()
+            except asyncio.TimeoutError:
+                await session.send({"type": "error", "detail": "Idle timeout"})
+                break
+            except (ValueError, KeyError):
+                # Frame không phải JSON (hoặc là frame binary): báo lỗi, giữ phiên
+                await session.send({"type": "error", "detail": "Invalid JSON message"})
+                continue
+
+            try:
+                request = ChatRequest(
+                    message=payload.get("message"),
+                    chat_id=session.chat_id,
+                    temp_message_id=payload.get("temp_message_id"),
+                    timeout_seconds=payload.get("timeout_seconds")
+                )
+                result = await run_chat_turn(
+                    request,
+                    session.token,
+                    session.context,
+                    Deadline.for_request(request.timeout_seconds),
+                    on_event=session.send,
+                    stream_text=True
+                )
+            except Exception as e:
+                print("Error in websocket chat turn:", str(e))
+                if session.is_closed():
+                    break
+                await session.send({"type": "error", "detail": str(e)})
+                continue
+
+            session.chat_id = result.data.get("chat_id") or session.chat_id
+            if result.data.get("user_message_id"):
+                session.remember_turn(request.message, result.response)
+            await session.send({"type": "response", **result.dict()})
+
+        # Đợi gửi hết event còn lại rồi đóng kết nối
+        if not session.is_closed():
+            await asyncio.wait_for(session.outbox.join(), timeout=5)
+            await websocket.close(code=1000)
+
+    except WebSocketDisconnect:
+        print("WebSocket client disconnected")
+    except Exception as e:
+        print("Error in websocket chat:", str(e))
+    finally:
+        if session and session.pump_task:
+            session.pump_task.cancel()
+        active_ws_sessions -= 1
+
+# =========================
+# ======= Chat Jobs =======
+# =========================
+
+class JobCancelled(Exception):
+    pass
+
+class ChatJob:
+    """Một yêu cầu /chat chạy nền"""
+
+    def __init__(
+        self,
+        request: ChatRequest,
+        token: Optional[str],
+        owner: str,
+        job_id: Optional[str] = None,
+        created_at: Optional[float] = None
+    ):
+        self.id = job_id or uuid.uuid4().hex
+        self.request = request
+        self.token = token
+        self.owner = owner  # get_user_key: theo user nên vẫn đúng khi JWT được cấp lại
+        self.priority = min(max(request.priority or 0, 0), 9)
+        # queued -> running -> done | failed | cancelled
+        # paused: job chưa chạy được khôi phục sau restart, chờ chủ job poll (token mới) để chạy tiếp
+        self.status = "queued"
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = created_at or time.time()
+        self.finished_at: Optional[float] = None
+        self.cancel_requested = False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "priority": self.priority,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "result": self.result,
+            "error": self.error
+        }
+
+    def to_record(self) -> Dict[str, Any]:
+        """Dữ liệu lưu lại khi tắt service (không lưu token)"""
+        return {
+            "id": self.id,
+            "owner": self.owner,
+            "request": self.request.dict(),
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at
+        }
+
+
+class JobManager:
+    """Hàng đợi ưu tiên + nhóm worker giới hạn cho các job chat chạy nền"""
+
+    INTERRUPTED_ERROR = "Interrupted by shutdown; some actions may already have been applied"
+
+    def __init__(self):
+        self.jobs: Dict[str, ChatJob] = {}
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self.workers: List[asyncio.Task] = []
+        self.running: Dict[str, asyncio.Task] = {}
+        self.closing = False
+        self._sequence = itertools.count()  # Giữ thứ tự FIFO giữa các job cùng priority
+
+    async def start(self):
+        self.closing = False
+        self.queue = asyncio.PriorityQueue()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(JOB_WORKERS)]
+
+        # Khôi phục job từ lần tắt trước. Job chưa chạy không có token nên ở trạng thái
+        # paused cho tới khi chủ job poll lại; job bị ngắt giữa chừng giữ trạng thái failed
+        if os.path.exists(JOB_STORE_PATH):
+            try:
+                with open(JOB_STORE_PATH, "r", encoding="utf-8") as f:
+                    records = json.load(f)
+                for record in records:
+                    job = ChatJob(
+                        ChatRequest(**record["request"]),
+                        None,
+                        record["owner"],
+                        job_id=record["id"],
+                        created_at=record["created_at"]
+                    )
+                    if record.get("status") in ("queued", "paused"):
+                        job.status = "paused"
+                    else:
+                        job.status = "failed"
+                        job.error = record.get("error") or self.INTERRUPTED_ERROR
+                        job.finished_at = time.time()
+                    self.jobs[job.id] = job
+                os.remove(JOB_STORE_PATH)
+                print(f"Restored {len(records)} chat jobs")
+            except Exception as e:
+                print(f"Error restoring chat jobs: {str(e)}")
+
+    async def stop(self):
+        # Ngừng nhận job mới và ngừng lấy job khỏi hàng đợi trước khi chờ
+        self.closing = True
+        for worker in self.workers:
+            worker.cancel()
+
+        # Cho các job đang chạy thời gian để hoàn thành
+        if self.running:
+            await asyncio.wait(list(self.running.values()), timeout=JOB_SHUTDOWN_GRACE_SECONDS)
+        # Còn chạy: dừng trước lần gọi model/backend tiếp theo, không cắt ngang lời gọi đang dở
+        if self.running:
+            for job_id in self.running:
+                self.jobs[job_id].cancel_requested = True
+            await asyncio.wait(list(self.running.values()), timeout=JOB_CANCEL_WAIT_SECONDS)
+        # Vẫn chưa dừng (lời gọi quá lâu): hủy hẳn để shutdown không bị treo
+        for task in list(self.running.values()):
+            task.cancel()
+        if self.running:
+            await asyncio.wait(list(self.running.values()), timeout=1)
+
+        # Lưu job chưa chạy (để chạy tiếp) và job bị ngắt (để client biết), không kèm token
+        self._prune()
+        records = []
+        for job in self.jobs.values():
+            if job.status == "running":
+                job.status = "failed"
+                job.error = self.INTERRUPTED_ERROR
+                job.finished_at = time.time()
+            if job.status in ("queued", "paused") or (job.status == "failed" and job.error == self.INTERRUPTED_ERROR):
+                records.append(job.to_record())
+        if records:
+            try:
+                with open(JOB_STORE_PATH, "w", encoding="utf-8") as f:
+                    json.dump(records, f, ensure_ascii=False)
+                print(f"Saved {len(records)} chat jobs")
+            except Exception as e:
+                print(f"Error saving chat jobs: {str(e)}")
+
+    def submit(self, job: ChatJob) -> ChatJob:
+        if self.closing:
+            raise HTTPException(status_code=503, detail="Service is shutting down")
+        self._prune()
+        if self.queue.qsize() >= JOB_QUEUE_MAX:
+            raise HTTPException(status_code=503, detail="Job queue is full")
+        self.jobs[job.id] = job
+        self._enqueue(job)
+        return job
+
+    def resume(self, job: ChatJob, token: str):
+        """Chạy tiếp job paused với token mới của chủ job"""
+        if job.status != "paused" or self.closing:
+            return
+        job.token = token
+        job.status = "queued"
+        self._enqueue(job)
+
+    def get(self, job_id: str, token: str, owner: str) -> ChatJob:
+        job = self.jobs.get(job_id)
+        # owner là hash token khi lúc tạo job không tra được user từ backend
+        if not job or job.owner not in (owner, get_token_key(token)):
+            raise HTTPException(status_code=404, detail="Job not found")
+        return job
+
+    def cancel(self, job: ChatJob):
+        if job.status in ("queued", "paused"):
+            job.status = "cancelled"
+            job.finished_at = time.time()
+        elif job.status == "running":
+            # Dừng trước lần gọi model/backend tiếp theo
+            job.cancel_requested = True
+
+    def _enqueue(self, job: ChatJob):
+        # PriorityQueue lấy giá trị nhỏ nhất trước nên đảo dấu priority
+        self.queue.put_nowait((-job.priority, next(self._sequence), job.id))
+
+    def _prune(self):
+        """Xóa các job đã kết thúc quá thời gian lưu giữ"""
+        expired_before = time.time() - JOB_RETENTION_SECONDS
+        for job_id, job in list(self.jobs.items()):
+            if job.finished_at and job.finished_at < expired_before:
+                del self.jobs[job_id]
+
+    async def _worker(self):
+        while not self.closing:
+            _, _, job_id = await self.queue.get()
+            job = self.jobs.get(job_id)
+            if not job or job.status != "queued":
+                continue
+            job.status = "running"
+            # Các lần gọi model/backend đã chạy ngoài event loop nên job chạy như một task bình thường.
+            # running do task tự dọn, để hủy worker lúc shutdown không làm mất dấu job đang chạy
+            task = asyncio.create_task(self._execute(job))
+            self.running[job.id] = task
+            task.add_done_callback(lambda _, job_id=job.id: self.running.pop(job_id, None))
+            await asyncio.wait([task])
+
+    async def _execute(self, job: ChatJob):
+        def check_cancelled():
+            if job.cancel_requested:
+                raise JobCancelled()
+
+        try:
+            deadline = Deadline(min(job.request.timeout_seconds or JOB_DEADLINE_SECONDS, JOB_DEADLINE_SECONDS))
+            check_cancelled()
+            context = await prepare_chat_context(job.request.chat_id, job.token, deadline)
+            result = await run_chat_turn(job.request, job.token, context, deadline, check_cancelled=check_cancelled)
+            if job.status == "running":
+                job.result = result.dict()
+                job.status = "done"
+        except JobCancelled:
+            if job.status == "running" and self.closing:
+                job.status = "failed"
+                job.error = self.INTERRUPTED_ERROR
+            elif job.status == "running":
+                job.status = "cancelled"
+        except Exception as e:
+            print(f"Error in chat job {job.id}:", str(e))
+            if job.status == "running":
+                job.status = "failed"
+                job.error = str(e)
+        finally:
+            job.finished_at = job.finished_at or time.time()
+
+        if job.request.notify and job.status in ("done", "failed"):
+            await asyncio.to_thread(notify_job_finished, job)
+
+
+def notify_job_finished(job: ChatJob):
+    """Gửi kết quả job qua luồng notifications của learning-app"""
+    # Người nhận là chủ của token (backend xác thực), không dùng user_id client gửi lên
+    user_id = resolve_token_user_id(job.token)
+    if not user_id:
+        print(f"Skip notification for job {job.id}: cannot resolve user from token")
+        return
+    if job.status == "done":
+        message = job.result["response"]
+    else:
+        message = "Xin lỗi, tôi chưa thể xử lý yêu cầu của bạn."
+    try:
+        call_backend_api(
+            endpoint="/notifications/create",
+            method="POST",
+            data={
+                "title": "Trợ lý AI",
+                "message": message[:500],
+                "receiverIds": [user_id]
+            },
+            token=job.token
+        )
+    except Exception as e:
+        print(f"Error sending notification for job {job.id}: {str(e)}")
+
+
+job_manager = JobManager()
+
+@app.get("/chat/jobs/{job_id}")
+async def get_chat_job(job_id: str, authorization: Optional[str] = Header(None)):
+    """Trạng thái và kết quả của một job chat"""
+    token = get_token_from_header(authorization)
+    if not token:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    job = job_manager.get(job_id, token, await asyncio.to_thread(get_user_key, token))
+    # Job khôi phục sau restart (paused) chạy tiếp với token mới của chủ job
+    job_manager.resume(job, token)
+    return job.to_dict()
+
+@app.delete("/chat/jobs/{job_id}")
+async def cancel_chat_job(job_id: str, authorization: Optional[str] = Header(None)):
+    """Hủy job chat đang chờ hoặc đang chạy"""
+    token = get_token_from_header(authorization)
+    if not token:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    job = job_manager.get(job_id, token, await asyncio.to_thread(get_user_key, token))
+    job_manager.cancel(job)
+    return job.to_dict()
+
+# =========================
+# ======= Chat Warm =======
+# =========================
+
+class WarmRequest(BaseModel):
+    chat_id: Optional[int] = None
+
+# Task warm đang chạy theo key, tránh gọi trùng khi UI gửi nhiều lần;
+# prepare_chat_context chờ task ("history", owner, chat_id) thay vì lấy lịch sử song song
+warm_tasks: Dict[Any, asyncio.Task] = {}
+
+async def warm_chat_context(chat_id: int, token: str):
+    started_at = time.monotonic()
+    history = await asyncio.to_thread(load_chat_history, chat_id, token)
+    # Lưu trên event loop: task bị hủy (lượt chat không chờ được) thì không lưu context cũ
+    context_cache.set((get_token_key(token), chat_id), (started_at, build_chat_context(history)))
+
+async def warm_class_list(token: str):
+    # Cùng tham số với find_classes không có bộ lọc
+    await asyncio.to_thread(prefetch_classes, prepare_find_classes_args({}), token)
+
+def schedule_warm(key, func, *args):
+    if key in warm_tasks:
+        return
+
+    async def run():
+        try:
+            await func(*args)
+        except Exception as e:
+            print(f"Error warming {key[0]}: {str(e)}")
+
+    task = asyncio.create_task(run())
+    warm_tasks[key] = task
+    task.add_done_callback(lambda _: warm_tasks.pop(key, None))
+
+@app.post("/chat/warm", status_code=202)
+async def warm_chat(request: WarmRequest, authorization: Optional[str] = Header(None)):
+    """Gọi khi mở khung chat: tải trước lịch sử và danh sách lớp học ở nền"""
+    token = get_token_from_header(authorization)
+    if not token:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    owner = get_token_key(token)
+    if request.chat_id:
+        schedule_warm(("history", owner, request.chat_id), warm_chat_context, request.chat_id, token)
+    schedule_warm(("classes", owner), warm_class_list, token)
+    return {"status": "warming"}
+
+# =========================
+# ===== Health Check ======
+# =========================
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: process còn chạy"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: backend và model đều đã warm thành công"""
+    if not app_state["ready"]:
+        raise HTTPException(status_code=503, detail="Service is not ready")
+    return {"status": "ready", **app_state}
+
+# =========================
+# ====== Debug API ========
+# =========================
+
+class ProfilingSettings(BaseModel):
+    sample_rate: Optional[float] = None
+    interval: Optional[float] = None
+
+@app.get("/debug/stats")
+async def debug_stats(x_admin_secret: Optional[str] = Header(None)):
+    """Thống kê event loop và profiling"""
+    require_admin_secret(x_admin_secret)
+    return {
+        "event_loop": loop_stats,
+        "profiling": profiling_config
+    }
+
+@app.post("/debug/profiling")
+async def update_profiling(settings: ProfilingSettings, x_admin_secret: Optional[str] = Header(None)):
+    """Bật/tắt profiling lúc chạy, không cần restart"""
+    require_admin_secret(x_admin_secret)
+    if settings.sample_rate is not None:
+        profiling_config["sample_rate"] = min(max(settings.sample_rate, 0.0), 1.0)
+    if settings.interval is not None:
+        profiling_config["interval"] = max(settings.interval, 0.001)
+    return profiling_config
+
 # =========================
 # ====== Run Server =======
 # =========================
@@ -648,6 +648,23 @@ const Assistant = () => {
     }
   }, [currentChatId, updateSource]);
 
+  // Warm up the chatbot (history + class list) as soon as a chat is opened
+  useEffect(() => {
+    const token = localStorage.getItem(ACCESS_TOKEN);
+    if (!token) return;
+
+    fetch("http://localhost:8000/chat/warm", {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+        Authorization: `Bearer ${token}`,
+      },
+      body: JSON.stringify(currentChatId ? { chat_id: Number(currentChatId) } : {}),
+    }).catch(() => {
+      // Warm-up is best effort
+    });
+  }, [currentChatId]);
+
   const handleSendMessage = async () => {
     const currentValue = inputRef.current?.getValue() || "";
     console.log("🚀 Sending message to server:", currentValue);
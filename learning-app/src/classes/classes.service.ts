@@ -312,6 +312,8 @@ export class ClassesService {
         learningDate,
         fetchAll = false,
         hasHistories = false,
+        cursor,
+        includeSessions = true,
       } = filterClassDto;
 
       // If no learningDate provided, use normal class search
@@ -335,17 +337,28 @@ export class ClassesService {
           sessionsWhereCondition.validTo = null;
         }
 
+        // Keyset pagination only when the caller sends a cursor (0 for the first page);
+        // page-based requests keep their current ordering
+        const useCursor = cursor !== undefined && cursor !== null;
+
         const findManyArgs: Prisma.ClassFindManyArgs = {
-          where: whereCondition,
-          include: {
-            sessions: {
-              where: sessionsWhereCondition,
+          where: useCursor
+            ? { ...whereCondition, id: { gt: cursor } }
+            : whereCondition,
+          ...(useCursor && { orderBy: { id: 'asc' } }),
+          ...(includeSessions && {
+            include: {
+              sessions: {
+                where: sessionsWhereCondition,
+              },
             },
-          },
+          }),
         };
 
         if (!fetchAll) {
-          findManyArgs.skip = (page - 1) * rowPerPage;
+          if (!useCursor) {
+            findManyArgs.skip = (page - 1) * rowPerPage;
+          }
           findManyArgs.take = rowPerPage;
         }
 
@@ -354,7 +367,13 @@ export class ClassesService {
           this.prismaService.class.count({ where: whereCondition }),
         ]);
 
-        return { total, data };
+        // Cursor for the next page, null when there is nothing left
+        const nextCursor =
+          useCursor && !fetchAll && data.length === rowPerPage
+            ? data[data.length - 1].id
+            : null;
+
+        return { total, data, nextCursor };
       }
 
       const currentDate = new Date();
@@ -53,4 +53,12 @@ export class FilterClassDto {
   @IsBoolean()
   @IsOptional()
   hasHistories: boolean = false;
+
+  @IsInt()
+  @IsOptional()
+  cursor: number; // Keyset pagination: classes with id greater than cursor, ordered by id (0 for the first page)
+
+  @IsBoolean()
+  @IsOptional()
+  includeSessions: boolean = true;
 }
@@ -17,6 +17,11 @@ export class FilterMessagesDto {
   @IsOptional()
   fetchAll?: boolean = false;
 
+  @Type(() => Number)
+  @IsNumber()
+  @IsOptional()
+  sinceId?: number; // Only messages with id greater than sinceId
+
   @Type(() => Number)
   @IsNumber()
   @Min(1)
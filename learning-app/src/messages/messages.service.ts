@@ -54,6 +54,7 @@ export class MessagesService {
       page = 1,
       limit = 10,
       isSaved,
+      sinceId,
     } = filterMessagesDto;
 
     const baseQuery = {
@@ -61,6 +62,7 @@ export class MessagesService {
         ...(chatId !== undefined && { chatId }), // Only add chatId if provided
         userId, // Only get messages of current user
         ...(isSaved !== undefined && { isSaved }), // Add isSaved filter if provided
+        ...(sinceId !== undefined && { id: { gt: sinceId } }), // Incremental fetch
       },
       orderBy: {
         createdAt: Prisma.SortOrder.asc,
@@ -82,6 +84,7 @@ export class MessagesService {
           ...(chatId !== undefined && { chatId }), // Only add chatId if provided
           userId, // Count only messages of current user
           ...(isSaved !== undefined && { isSaved }),
+          ...(sinceId !== undefined && { id: { gt: sinceId } }),
         },
       }),
     ]);